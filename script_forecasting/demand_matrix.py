@@ -0,0 +1,123 @@
+"""
+    Dense series x day demand matrix: the shared in-memory structure for one tenant.
+
+    Built ONCE from the aggregated daily sales. Row i is one series (see `index` for its
+    location/item/variation), column j is one calendar day, days without sales are 0.
+    `observed` marks the days that had an aggregated row, so a day whose sales and
+    returns net to 0 still counts as a day with sales, as in the long format.
+    History-quality stats, fallbacks and model inputs read views of `values` instead of
+    slicing/sorting/renaming a long DataFrame per series.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Tenants whose matrix exceeds this are backed by a file in mmap_dir instead of RAM
+MMAP_MIN_BYTES = 256 * 1024 ** 2
+
+
+class DemandMatrix:
+
+    def __init__(self, values, observed, index, days):
+        self.values = values        # (n_series, n_days) array or np.memmap
+        self.observed_mask = observed  # same shape, bool: day had an aggregated row
+        self.index = index          # DataFrame, row i -> key columns of series i
+        self.days = days            # DatetimeIndex of the columns
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def row(self, i):
+        return self.values[i]
+
+    def observed(self, i):
+        # Days that actually had sales rows, i.e. what the long format used to carry
+        pos = np.flatnonzero(self.observed_mask[i])
+        return self.days[pos], self.values[i][pos]
+
+    def last_observed_mean(self, i, n=7):
+        pos = np.flatnonzero(self.observed_mask[i])[-n:]
+        return float(self.values[i][pos].mean()) if len(pos) else 0.0
+
+    def group_slices(self, column):
+        # Rows are sorted by key, so every value of the leading key column is one contiguous block
+        labels = self.index[column].to_numpy()
+        bounds = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+        starts = np.concatenate([[0], bounds])
+        ends = np.concatenate([bounds, [len(labels)]])
+        return [(labels[s], slice(s, e)) for s, e in zip(starts, ends)]
+
+
+def _allocate(shape, dtype, mmap_dir, mmap_min_bytes):
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if mmap_dir is None or nbytes < mmap_min_bytes:
+        return np.zeros(shape, dtype=dtype)
+    fd, path = tempfile.mkstemp(suffix='.npy', prefix='demand_', dir=mmap_dir)
+    os.close(fd)
+    values = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    # The mapping outlives the directory entry, so the file is cleaned up with the process
+    os.unlink(path)
+    return values
+
+
+def build_demand_matrix(long_df, keys, date_col='date', y_col='y', start=None, end=None,
+                        dtype=np.float64, mmap_dir=None, mmap_min_bytes=MMAP_MIN_BYTES):
+    dates = pd.to_datetime(long_df[date_col]).dt.normalize()
+    start = pd.Timestamp(start).normalize() if start is not None else dates.min()
+    end = pd.Timestamp(end).normalize() if end is not None else dates.max()
+    in_range = ((dates >= start) & (dates <= end)).to_numpy()
+    df = long_df.loc[in_range, keys + [y_col]]
+    dates = dates[in_range]
+
+    codes = df.groupby(keys, sort=True).ngroup().to_numpy()
+    index = df[keys].drop_duplicates().sort_values(keys).reset_index(drop=True)
+    days = pd.date_range(start, end, freq='D')
+    day_pos = (dates - start).dt.days.to_numpy()
+
+    shape = (len(index), len(days))
+    values = _allocate(shape, dtype, mmap_dir, mmap_min_bytes)
+    np.add.at(values, (codes, day_pos), df[y_col].to_numpy(dtype=dtype))
+    observed = _allocate(shape, np.bool_, mmap_dir, mmap_min_bytes)
+    observed[codes, day_pos] = True
+    return DemandMatrix(values, observed, index, days)
+
+
+def _count_distinct_periods(observed, labels):
+    # labels: per-day period id (e.g. ISO week). Reduce each contiguous run of days with
+    # np.logical_or.reduceat (no n_series x n_days temporaries), then merge runs sharing a label
+    bounds = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+    starts = np.concatenate([[0], bounds])
+    sold_runs = np.logical_or.reduceat(observed, starts, axis=1)
+    run_labels = labels[starts]
+    sold = np.zeros((observed.shape[0], len(np.unique(run_labels))), dtype=bool)
+    for j, label in enumerate(np.unique(run_labels)):
+        sold[:, j] = sold_runs[:, run_labels == label].any(axis=1)
+    return sold.sum(axis=1)
+
+
+def history_stats(matrix):
+    # Per-series stats over observed days, same definitions as the old groupby/agg
+    # (unobserved cells are 0, so they drop out of the sums)
+    values = matrix.values
+    observed = matrix.observed_mask
+    iso = matrix.days.isocalendar()
+    counts = np.count_nonzero(observed, axis=1)
+    sums = values.sum(axis=1)
+    sumsq = np.einsum('ij,ij->i', values, values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums / counts
+        var = (sumsq - counts * mean ** 2) / (counts - 1)
+        std = np.sqrt(np.clip(var, 0, None))
+        cv = std / mean
+
+    stats = matrix.index.copy()
+    stats['num_days_with_sales'] = counts
+    stats['num_weeks_with_sales'] = _count_distinct_periods(observed, iso['week'].to_numpy())
+    stats['num_years_with_sales'] = _count_distinct_periods(observed, iso['year'].to_numpy())
+    stats['mean'] = mean
+    stats['std'] = std
+    stats['cv'] = cv
+    return stats
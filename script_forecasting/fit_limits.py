@@ -0,0 +1,75 @@
+"""
+    Per-fit time and iteration limits for Prophet/CmdStan.
+
+    Prophet forwards extra fit() kwargs to cmdstanpy's optimize(), which kills the
+    CmdStan process and raises TimeoutError once `timeout` seconds have passed. Callers
+    catch that, fall back to the cheap path and record the series, so one pathological
+    series cannot stall the rest of the tenant. When L-BFGS fails, Prophet retries with
+    Newton using the same args; fit_prophet() charges that retry against the same
+    `timeout` and drops the L-BFGS-only options for it.
+"""
+
+import time
+
+import numpy as np
+
+DEFAULT_FIT_TIMEOUT = 60
+
+# cmdstanpy rejects L-BFGS-only tolerances (ValueError) when the algorithm is Newton,
+# which Prophet uses below 100 history rows and for its retry after an L-BFGS failure
+LBFGS_ONLY = ('tol_rel_grad',)
+
+
+def prophet_fit_kwargs(timeout=None, max_iter=None, tol_rel_grad=None):
+    # Limits for fit_prophet(); empty dict = Prophet's defaults
+    kwargs = {}
+    if timeout:
+        kwargs['timeout'] = timeout
+    if max_iter:
+        # CmdStan treats hitting the cap as a normal exit and returns the last iterate
+        kwargs['iter'] = max_iter
+    if tol_rel_grad:
+        kwargs['tol_rel_grad'] = tol_rel_grad
+    return kwargs
+
+
+def fit_prophet(m, df, fit_kwargs=None):
+    # m.fit(df) under fit_kwargs from prophet_fit_kwargs(). Every optimize() call of this
+    # fit (first attempt and Prophet's Newton retry) goes through `limited`, so the
+    # timeout bounds the whole fit rather than each attempt
+    fit_kwargs = dict(fit_kwargs or {})
+    timeout = fit_kwargs.pop('timeout', None)
+    deadline = time.monotonic() + timeout if timeout else None
+    model = m.stan_backend.model
+    optimize = model.optimize
+
+    def limited(**args):
+        if args.get('algorithm') == 'Newton':
+            args = {k: v for k, v in args.items() if k not in LBFGS_ONLY}
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"fit exceeded its {timeout}s time limit")
+            args['timeout'] = remaining
+        return optimize(**args)
+
+    model.optimize = limited
+    try:
+        return m.fit(df, **fit_kwargs)
+    finally:
+        del model.optimize
+
+
+def report_fit_times(label, fit_seconds, timed_out, failed=()):
+    # fit_seconds: completed fits only; timeouts and failed fits are reported separately
+    # so a fast-failing fit never shows up as a fast fit in p50/p99
+    if fit_seconds:
+        p50, p99 = np.percentile(fit_seconds, [50, 99])
+        print(f"[FIT] {label}: {len(fit_seconds)} fits, p50 {p50:.1f}s, p99 {p99:.1f}s, "
+              f"max {max(fit_seconds):.1f}s, {len(timed_out)} timed out, {len(failed)} failed")
+    elif timed_out or failed:
+        print(f"[FIT] {label}: 0 fits, {len(timed_out)} timed out, {len(failed)} failed")
+    for series in timed_out:
+        print(f"[TIMEOUT] {label}: {series} fell back to the recent-average forecast")
+    for series, error in failed:
+        print(f"[FIT FAILED] {label}: {series} fell back to the recent-average forecast: {error}")
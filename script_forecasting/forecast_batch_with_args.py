@@ -3,12 +3,22 @@
 """
 
 import argparse
+import time
+from functools import partial
+
 import pandas as pd
 import numpy as np
 from prophet import Prophet
 import sqlalchemy
 import pymysql
 
+from demand_matrix import build_demand_matrix, history_stats
+from fit_limits import DEFAULT_FIT_TIMEOUT, fit_prophet, prophet_fit_kwargs, report_fit_times
+from global_forecast import forecast_global_frame
+from level_writes import upsert_changed_levels
+from parquet_sink import reset_partition, write_partition
+from sharding import plan_shards, run_shards
+
 # ========== 1. Helper: Ensure Columns Exist in Table ==========
 
 def ensure_column_exists(engine, table, column, dtype):
@@ -55,6 +65,17 @@ def upsert_forecasted_levels(results_df, engine):
                 "forecasted_replenish_level": row['forecasted_replenish_level']
             })
 
+def write_forecasted_levels(results_df, engine, write_mode='changed', tolerance=0):
+    # 'changed' only upserts rows whose levels moved by more than `tolerance`; 'all' rewrites every row.
+    # Both return {'changed': rows written, 'skipped': rows left as they were}
+    if write_mode == 'changed':
+        return upsert_changed_levels(
+            results_df, engine, 'phppos_location_item_variations', 'item_variation_id', 'variation_id', tolerance
+        )
+    upsert_forecasted_levels(results_df, engine)
+    return {'changed': len(results_df), 'skipped': 0}
+
+
 # ========== 3. Write Full ML Results ==========
 
 def write_results_to_db(results_df, engine):
@@ -70,6 +91,7 @@ def write_results_to_db(results_df, engine):
                 z_score FLOAT,
                 demand_lt FLOAT,
                 sigma_lt FLOAT,
+                fit_status VARCHAR(16),
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (location_id)
                     REFERENCES phppos_locations(location_id)
@@ -77,6 +99,8 @@ def write_results_to_db(results_df, engine):
         """
     with engine.connect() as conn:
         conn.execute(sqlalchemy.text(create_table_query))
+    # Tables created before fit_status existed
+    ensure_column_exists(engine, 'phppos_item_variation_forecasts', 'fit_status', 'VARCHAR(16) DEFAULT NULL')
     results_df.to_sql(
         'phppos_item_variation_forecasts',
         engine,
@@ -122,10 +146,7 @@ def get_databases_to_process(server):
 
 # ========== 5. Forecasting Logic ==========
 
-def run_forecast_for_database(conn_str, output_path=None):
-    engine = sqlalchemy.create_engine(conn_str)
-    variations_df = pd.read_sql_query(
-        """SELECT phppos_sales.sale_time, phppos_sales_items.quantity_purchased, phppos_items.name,
+VARIATIONS_SQL = """SELECT phppos_sales.sale_time, phppos_sales_items.quantity_purchased, phppos_items.name,
         GROUP_CONCAT(DISTINCT phppos_attributes.name, ": ", phppos_attribute_values.name SEPARATOR ", ") as variation_name, 
         phppos_sales_items.sale_id, phppos_sales_items.item_id, phppos_sales_items.item_variation_id, phppos_sales.location_id, 
         phppos_sales_items.total 
@@ -136,8 +157,93 @@ def run_forecast_for_database(conn_str, output_path=None):
         INNER JOIN phppos_item_variation_attribute_values ON phppos_item_variation_attribute_values.item_variation_id = phppos_sales_items.item_variation_id
         INNER JOIN phppos_attribute_values ON phppos_item_variation_attribute_values.attribute_value_id = phppos_attribute_values.id 
         INNER JOIN phppos_attributes ON phppos_attributes.id = phppos_attribute_values.attribute_id 
-        GROUP BY phppos_sales_items.sale_id, phppos_sales_items.item_id,phppos_sales_items.item_variation_id""", engine
-    )
+        {where}
+        GROUP BY phppos_sales_items.sale_id, phppos_sales_items.item_id,phppos_sales_items.item_variation_id"""
+
+
+def variations_query(location_ids=None, cutoff=None):
+    # Returns (query, params); location and sale_time filters are pushed into SQL
+    conditions, params, expanding = [], {}, []
+    if location_ids is not None:
+        conditions.append('phppos_sales.location_id IN :location_ids')
+        params['location_ids'] = list(location_ids)
+        expanding.append(sqlalchemy.bindparam('location_ids', expanding=True))
+    if cutoff is not None:
+        conditions.append('phppos_sales.sale_time >= :cutoff')
+        params['cutoff'] = pd.Timestamp(cutoff).to_pydatetime()
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+    query = sqlalchemy.text(VARIATIONS_SQL.format(where=where)).bindparams(*expanding)
+    return query, params or None
+
+
+def variation_day_counts(engine, cutoff=None):
+    # Per-location size and latest day of the daily aggregate from `cutoff` on, mirroring
+    # the pandas aggregation in run_forecast_for_database
+    query, params = variations_query(cutoff=cutoff)
+    return pd.read_sql_query(sqlalchemy.text(f"""
+        SELECT d.location_id, COUNT(*) AS n_rows, MAX(d.sale_date) AS latest
+        FROM (
+            SELECT DATE(v.sale_time) AS sale_date, v.location_id, SUM(v.quantity_purchased) AS qty
+            FROM ({query.text}) AS v
+            GROUP BY sale_date, v.item_id, v.item_variation_id, v.location_id, v.variation_name, v.name
+        ) AS d
+        WHERE d.qty >= 0
+        GROUP BY d.location_id
+    """), engine, params=params, parse_dates=['latest'])
+
+
+def plan_variation_shards(engine):
+    # Per-location row counts of the 12-month window + the tenant-wide latest sales day,
+    # so every shard loads and forecasts the same window as an unsharded run.
+    # A cheap MAX over the raw rows bounds the latest day from above, so the GROUP_CONCAT
+    # join normally runs over the window only. If the last days net out to returns, the
+    # window is re-read from the actual latest day (all history if the whole window did).
+    bound = pd.read_sql_query(sqlalchemy.text("""
+        SELECT MAX(DATE(phppos_sales.sale_time)) AS latest
+        FROM phppos_sales_items
+        INNER JOIN phppos_sales USING(sale_id)
+        WHERE phppos_sales_items.item_variation_id IS NOT NULL
+    """), engine, parse_dates=['latest'])['latest'].iloc[0]
+    if pd.isna(bound):
+        return {}, None
+
+    cutoff = bound - pd.DateOffset(months=12)
+    while True:
+        stats = variation_day_counts(engine, cutoff)
+        latest = stats['latest'].max()
+        if pd.isna(latest):
+            if cutoff is None:
+                return {}, None
+            cutoff = None
+            continue
+        if cutoff == latest - pd.DateOffset(months=12):
+            break
+        cutoff = latest - pd.DateOffset(months=12)
+    return dict(zip(stats['location_id'].tolist(), stats['n_rows'].tolist())), latest
+
+
+def global_forecast_results(matrix, history_quality, lead_time_days, pool_by):
+    # Same output columns as the per-series Prophet loop, from ONE pooled fit per tenant/location
+    fc = forecast_global_frame(matrix, lead_days=lead_time_days, pool_by=pool_by)
+    fc['enough_history'] = history_quality['enough_history']
+    fc['z_score'] = history_quality['z_score']
+    fc['forecasted_reorder_level'] = np.round(fc['demand_lt'] + fc['z_score'] * fc['sigma_lt']).astype(int)
+    fc['forecasted_replenish_level'] = np.round(fc['forecasted_reorder_level'] + fc['demand_lt']).astype(int)
+    fc['fit_status'] = 'global'
+    return fc[['location_id', 'item_id', 'variation_id',
+               'forecasted_reorder_level', 'forecasted_replenish_level',
+               'enough_history', 'z_score', 'demand_lt', 'sigma_lt', 'fit_status']]
+
+
+def run_forecast_for_database(conn_str, output_path=None, model='prophet', pool_by=None, mmap_dir=None,
+                              location_ids=None, latest_date=None, fit_kwargs=None):
+    # fit_kwargs: Prophet.fit limits from prophet_fit_kwargs (timeout / iteration / tolerance caps)
+    engine = sqlalchemy.create_engine(conn_str)
+    # Shards pass the tenant-wide latest day (see plan_variation_shards) and only load
+    # the 12-month window they were sized by; older rows never reach the matrix anyway
+    cutoff = latest_date - pd.DateOffset(months=12) if latest_date is not None else None
+    query, params = variations_query(location_ids, cutoff)
+    variations_df = pd.read_sql_query(query, engine, params=params)
     variations_df['sale_date'] = pd.to_datetime(variations_df['sale_time']).dt.date
 
     agg_df = variations_df.groupby(
@@ -147,36 +253,31 @@ def run_forecast_for_database(conn_str, output_path=None):
     # track returns for inspection if needed
     returns = agg_df[agg_df['quantity_purchased'] < 0]
     agg_df = agg_df[agg_df['quantity_purchased'] >= 0]
+    if agg_df.empty:
+        # No variation sales (tenant without variations, or only returns)
+        print("[WARN] No variation sales found.")
+        return pd.DataFrame()
 
-    recent_daily_var_sales = agg_df.rename(
+    agg_df = agg_df.rename(
         columns={
             'sale_date': 'date',
-            'item_id': 'item_id',
             'item_variation_id': 'variation_id',
             'quantity_purchased': 'y'
         }
     )
-    recent_daily_var_sales['date'] = pd.to_datetime(recent_daily_var_sales['date'])
-    latest_date = recent_daily_var_sales['date'].max()
+    agg_df['date'] = pd.to_datetime(agg_df['date'])
+    # Shards get the tenant-wide latest date so their window matches the unsharded run
+    if latest_date is None:
+        latest_date = agg_df['date'].max()
     cutoff_date = latest_date - pd.DateOffset(months=12)
-    recent_12m = recent_daily_var_sales[recent_daily_var_sales['date'] >= cutoff_date].copy()
-    recent_12m['sales_week'] = recent_12m['date'].dt.isocalendar().week
-    recent_12m['sales_year'] = recent_12m['date'].dt.isocalendar().year
-
-    history_quality = (
-        recent_12m.groupby(['location_id', 'variation_id'])
-        .agg(
-            num_days_with_sales=('date', 'nunique'),
-            num_weeks_with_sales=('sales_week', 'nunique'),
-            num_years_with_sales=('sales_year', 'nunique')
-        ).reset_index()
-    )
 
-    history_quality = history_quality.merge(
-        recent_12m[['location_id', 'variation_id', 'variation_name', 'name']].drop_duplicates(),
-        on=['location_id', 'variation_id'],
-        how='left'
+    # Dense series x day matrix of the last 12 months, built once; stats, fallbacks
+    # and model inputs below all read views of it (row i <-> history_quality row i)
+    matrix = build_demand_matrix(
+        agg_df, ['location_id', 'item_id', 'variation_id'],
+        start=cutoff_date, end=latest_date, mmap_dir=mmap_dir
     )
+    history_quality = history_stats(matrix)
 
     min_days = 20
     min_weeks = 4
@@ -185,13 +286,6 @@ def run_forecast_for_database(conn_str, output_path=None):
         (history_quality['num_weeks_with_sales'] >= min_weeks)
     )
 
-    demand_stats = (
-        recent_12m.groupby(['location_id', 'variation_id'])['y']
-        .agg(['mean', 'std'])
-        .reset_index()
-    )
-    demand_stats['cv'] = demand_stats['std'] / demand_stats['mean']
-
     def select_z(cv):
         if cv < 0.5:
             return 1.65
@@ -200,43 +294,38 @@ def run_forecast_for_database(conn_str, output_path=None):
         else:
             return 2.33
 
-    demand_stats['z_score'] = demand_stats['cv'].apply(select_z)
-    history_quality = history_quality.merge(
-        demand_stats[['location_id', 'variation_id', 'cv', 'z_score']],
-        on=['location_id', 'variation_id'],
-        how='left'
-    )
-
-    grouped_sales = (
-        recent_12m.groupby(['date', 'location_id', 'item_id', 'variation_id'])
-        .agg({'y': 'sum'})
-        .reset_index()
-    )
-
-    grouped_sales = grouped_sales.merge(
-        history_quality[['location_id', 'variation_id', 'enough_history']],
-        on=['location_id', 'variation_id'],
-        how='left'
-    )
+    history_quality['z_score'] = history_quality['cv'].apply(select_z)
 
     lead_time_days = 7
+    if model == 'global':
+        results_df = global_forecast_results(matrix, history_quality, lead_time_days, pool_by)
+        if output_path:
+            results_df.to_csv(output_path, index=False)
+        return results_df
+
     results = []
     min_sigma = 1
-    for (loc, item, var), group in grouped_sales.groupby(['location_id', 'item_id', 'variation_id']):
-        enough = group['enough_history'].iloc[0]
-        group = group.sort_values('date')
-        prophet_df = group[['date', 'y']].rename(columns={'date': 'ds', 'y': 'y'})
-        prophet_df['ds'] = pd.to_datetime(prophet_df['ds'])
-        z_row = history_quality.query('location_id == @loc and variation_id == @var')
-        z = z_row['z_score'].iloc[0] if not z_row.empty else 1.65
+    fit_seconds, timed_out, failed = [], [], []
+    for i, (loc, item_id, var) in enumerate(
+        matrix.index[['location_id', 'item_id', 'variation_id']].itertuples(index=False)
+    ):
+        enough = history_quality.at[i, 'enough_history']
+        z = history_quality.at[i, 'z_score']
 
         reorder_level = None
         replenish_level = None
+        # ok / timeout / failed: Prophet fit; fallback: not enough history for one
+        fit_status = 'fallback'
 
         if enough:
             try:
+                ds, y = matrix.observed(i)
+                prophet_df = pd.DataFrame({'ds': ds, 'y': y})
                 m = Prophet(daily_seasonality=True)
-                m.fit(prophet_df)
+                started = time.perf_counter()
+                fit_prophet(m, prophet_df, fit_kwargs)
+                fit_seconds.append(time.perf_counter() - started)
+                fit_status = 'ok'
                 future = m.make_future_dataframe(periods=lead_time_days)
                 forecast = m.predict(future)
                 lead_forecast = forecast.tail(lead_time_days)
@@ -246,20 +335,22 @@ def run_forecast_for_database(conn_str, output_path=None):
                 reorder_level = int(np.round(demand_lt + safety_stock))
                 replenish_level = int(np.round(reorder_level + demand_lt))
             except Exception as e:
-                last_week = prophet_df.sort_values('ds').tail(7)
-                avg_daily = last_week['y'].mean() if len(last_week) else 1
-                demand_lt = avg_daily * lead_time_days
+                if isinstance(e, TimeoutError):
+                    fit_status = 'timeout'
+                    timed_out.append((loc, item_id, var))
+                else:
+                    fit_status = 'failed'
+                    failed.append(((loc, item_id, var), repr(e)))
+                sigma_lt = min_sigma
+                demand_lt = matrix.last_observed_mean(i) * lead_time_days
                 reorder_level = int(np.round(demand_lt))
                 replenish_level = int(np.round(demand_lt * 2))
         else:
             sigma_lt = min_sigma
-            last_week = prophet_df.sort_values('ds').tail(7)
-            avg_daily = last_week['y'].mean() if len(last_week) else 1
-            demand_lt = avg_daily * lead_time_days
+            demand_lt = matrix.last_observed_mean(i) * lead_time_days
             reorder_level = int(np.round(demand_lt))
             replenish_level = int(np.round(demand_lt * 2))
 
-        item_id = group['item_id'].iloc[0] if 'item_id' in group.columns else None
         results.append({
             'location_id': loc,
             'item_id': item_id,
@@ -269,14 +360,34 @@ def run_forecast_for_database(conn_str, output_path=None):
             'enough_history': enough,
             'z_score': z,
             'demand_lt': demand_lt,
-            'sigma_lt': sigma_lt
+            'sigma_lt': sigma_lt,
+            'fit_status': fit_status
         })
 
+    report_fit_times('variation', fit_seconds, timed_out, failed)
     results_df = pd.DataFrame(results)
     if output_path:
         results_df.to_csv(output_path, index=False)
     return results_df
 
+def run_forecast_sharded(conn_str, max_rows_per_shard, max_workers=1, memory_limit_mb=None,
+                         on_shard=None, model='prophet', pool_by=None, mmap_dir=None, fit_kwargs=None):
+    # Same results as run_forecast_for_database, one location group at a time
+    if model == 'global' and pool_by != 'location_id':
+        raise ValueError("Sharded mode with the global model needs pool_by='location_id'")
+    engine = sqlalchemy.create_engine(conn_str)
+    location_rows, latest_date = plan_variation_shards(engine)
+    if not location_rows:
+        return pd.DataFrame()
+    shards = plan_shards(location_rows, max_rows_per_shard)
+    print(f"[SHARD] {len(location_rows)} locations -> {len(shards)} shards")
+    fn = partial(
+        run_forecast_for_database, conn_str, model=model, pool_by=pool_by,
+        mmap_dir=mmap_dir, latest_date=latest_date, fit_kwargs=fit_kwargs
+    )
+    parts = run_shards(fn, shards, max_workers, memory_limit_mb, on_result=on_shard)
+    return pd.concat(parts, ignore_index=True)
+
 # ========== 6. Main Orchestration ==========
 
 def main():
@@ -285,8 +396,83 @@ def main():
         'db_arg',
         help="Use -1 for all DBs, N (positive int) for first N DBs, or the DB name for a single DB"
     )
+    parser.add_argument(
+        '--model',
+        choices=['prophet', 'global'],
+        default='prophet',
+        help="prophet = one Prophet fit per series, global = one pooled fit per tenant (see --pool-by)"
+    )
+    parser.add_argument(
+        '--pool-by',
+        choices=['tenant', 'location'],
+        default='tenant',
+        help="Scope of the pooled fit when --model global is used"
+    )
+    parser.add_argument(
+        '--mmap-dir',
+        default=None,
+        help="Directory for memory-mapping the demand matrix of very large tenants (default: keep in RAM)"
+    )
+    parser.add_argument(
+        '--output-dir',
+        default='forecast_output',
+        help="Root of the Parquet output dataset (partitioned by run date and tenant)"
+    )
+    parser.add_argument(
+        '--shard-rows',
+        type=int,
+        default=0,
+        help="Process each tenant in location shards of at most ~N daily rows (0 = whole tenant at once)"
+    )
+    parser.add_argument(
+        '--shard-workers',
+        type=int,
+        default=1,
+        help="Number of shards forecast in parallel when --shard-rows is set"
+    )
+    parser.add_argument(
+        '--memory-limit-mb',
+        type=int,
+        default=None,
+        help="Memory ceiling for shards in flight (estimated from their row counts)"
+    )
+    parser.add_argument(
+        '--write-mode',
+        choices=['changed', 'all'],
+        default='changed',
+        help="changed = only upsert forecasted levels that moved, all = rewrite every row"
+    )
+    parser.add_argument(
+        '--level-tolerance',
+        type=int,
+        default=0,
+        help="With --write-mode changed, ignore level changes of at most this many units"
+    )
+    parser.add_argument(
+        '--fit-timeout',
+        type=float,
+        default=DEFAULT_FIT_TIMEOUT,
+        help="Seconds a single Prophet fit, including its Newton retry, may run before it is killed and the series falls back (0 = no limit)"
+    )
+    parser.add_argument(
+        '--fit-max-iter',
+        type=int,
+        default=None,
+        help="Cap on optimizer iterations per Prophet fit (default: Prophet's 10000)"
+    )
+    parser.add_argument(
+        '--fit-tol-rel-grad',
+        type=float,
+        default=None,
+        help="Relative gradient tolerance for L-BFGS fits (series with >= 100 days, not the Newton retry; default: CmdStan's)"
+    )
     args = parser.parse_args()
+    if args.shard_rows and args.model == 'global' and args.pool_by != 'location':
+        parser.error("--shard-rows with --model global needs --pool-by location")
     arg = args.db_arg
+    pool_by = 'location_id' if args.pool_by == 'location' else None
+    fit_kwargs = prophet_fit_kwargs(args.fit_timeout, args.fit_max_iter, args.fit_tol_rel_grad)
+    run_date = pd.Timestamp.today().date()
 
     # Loop through all DB_SERVERS (even if just one)
 
@@ -342,9 +528,30 @@ def main():
             engine = sqlalchemy.create_engine(conn_str)
             try:
                 ensure_schema(engine)
-                results_df = run_forecast_for_database(conn_str, output_path=f"forecast_{db_name}.csv")
-                write_results_to_db(results_df, engine)
-                upsert_forecasted_levels(results_df, engine)
+                reset_partition(args.output_dir, 'variation', run_date, db_name)
+                if args.shard_rows:
+                    # Each shard is written out as soon as it finishes
+                    def write_shard(shard_no, shard_df, db_name=db_name, engine=engine):
+                        write_partition(shard_df, args.output_dir, 'variation', db_name, run_date, part=shard_no)
+                        write_results_to_db(shard_df, engine)
+                        write_forecasted_levels(shard_df, engine, args.write_mode, args.level_tolerance)
+
+                    run_forecast_sharded(
+                        conn_str, args.shard_rows, args.shard_workers, args.memory_limit_mb,
+                        on_shard=write_shard, model=args.model, pool_by=pool_by, mmap_dir=args.mmap_dir,
+                        fit_kwargs=fit_kwargs
+                    )
+                else:
+                    results_df = run_forecast_for_database(
+                        conn_str, model=args.model, pool_by=pool_by, mmap_dir=args.mmap_dir,
+                        fit_kwargs=fit_kwargs
+                    )
+                    if results_df.empty:
+                        print(f"[SKIPPED] No variation sales for DB: {db_name}")
+                    else:
+                        write_partition(results_df, args.output_dir, 'variation', db_name, run_date)
+                        write_results_to_db(results_df, engine)
+                        write_forecasted_levels(results_df, engine, args.write_mode, args.level_tolerance)
                 print(f"Finished {db_name}")
             except Exception as e:
                 print(f"Failed for {db_name}: {e}")
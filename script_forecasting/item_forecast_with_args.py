@@ -5,6 +5,14 @@ import sqlalchemy
 import pymysql
 from sqlalchemy import text
 import argparse
+import time
+from functools import partial
+
+from demand_matrix import build_demand_matrix, history_stats
+from fit_limits import DEFAULT_FIT_TIMEOUT, fit_prophet, prophet_fit_kwargs, report_fit_times
+from level_writes import upsert_changed_levels
+from parquet_sink import reset_partition, write_partition
+from sharding import plan_shards, run_shards
 
 # ---------- 1. Generic helpers ----------
 
@@ -54,6 +62,17 @@ def upsert_forecasted_levels_for_items(results_df, engine):
             })
 
 
+def write_forecasted_levels_for_items(results_df, engine, write_mode='changed', tolerance=0):
+    # 'changed' only upserts rows whose levels moved by more than `tolerance`; 'all' rewrites every row.
+    # Both return {'changed': rows written, 'skipped': rows left as they were}
+    if write_mode == 'changed':
+        return upsert_changed_levels(
+            results_df, engine, 'phppos_location_items', 'item_id', 'item_id', tolerance
+        )
+    upsert_forecasted_levels_for_items(results_df, engine)
+    return {'changed': len(results_df), 'skipped': 0}
+
+
 def write_results_to_db(results_df, engine):
     create_table_query = """
     CREATE TABLE IF NOT EXISTS phppos_item_variation_forecasts (
@@ -67,6 +86,7 @@ def write_results_to_db(results_df, engine):
         z_score FLOAT,
         demand_lt FLOAT,
         sigma_lt FLOAT,
+        fit_status VARCHAR(16),
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY (location_id)
             REFERENCES phppos_locations(location_id)
@@ -74,6 +94,8 @@ def write_results_to_db(results_df, engine):
     """
     with engine.connect() as conn:
         conn.execute(sqlalchemy.text(create_table_query))
+    # Tables created before fit_status existed
+    ensure_column_exists(engine, 'phppos_item_variation_forecasts', 'fit_status', 'VARCHAR(16) DEFAULT NULL')
     results_df['variation_id'] = None  # Explicitly set NULL for item-level rows
     results_df.to_sql(
         'phppos_item_variation_forecasts',
@@ -90,57 +112,131 @@ def write_results_to_db(results_df, engine):
 
 
 
-def run_item_forecast_for_database(conn_str, top_n=200):
-    engine = sqlalchemy.create_engine(conn_str)
-    item_sql = """
+ITEM_DAILY_SQL = """
       SELECT date(sale_time) AS sale_date,
              location_id,
              item_id,
              SUM(quantity_purchased) AS qty
       FROM phppos_sales_items
       INNER JOIN phppos_sales USING(sale_id)
-      WHERE quantity_purchased > 0
+      WHERE quantity_purchased > 0 {filters}
       GROUP BY sale_date, location_id, item_id
     """
-    daily = pd.read_sql(item_sql, engine, parse_dates=['sale_date'])
+
+
+def plan_item_shards(engine, top_n=200):
+    # Tenant-wide latest day, top items and per-location row counts, so location
+    # shards use the same window and the same item list as an unsharded run
+    latest = pd.read_sql(text("""
+      SELECT MAX(date(sale_time)) AS latest
+      FROM phppos_sales_items
+      INNER JOIN phppos_sales USING(sale_id)
+      WHERE quantity_purchased > 0
+    """), engine, parse_dates=['latest'])['latest'].iloc[0]
+    if pd.isna(latest):
+        return {}, None, []
+    cutoff = latest - pd.DateOffset(months=12)
+    per_item = pd.read_sql(text("""
+      SELECT location_id,
+             item_id,
+             SUM(quantity_purchased) AS qty,
+             COUNT(DISTINCT date(sale_time)) AS n_days
+      FROM phppos_sales_items
+      INNER JOIN phppos_sales USING(sale_id)
+      WHERE quantity_purchased > 0 AND sale_time >= :cutoff
+      GROUP BY location_id, item_id
+    """), engine, params={'cutoff': cutoff.to_pydatetime()})
+    top_items = (per_item.groupby('item_id')['qty']
+                 .sum()
+                 .nlargest(top_n)
+                 .index.tolist())
+    rows = per_item[per_item['item_id'].isin(top_items)].groupby('location_id')['n_days'].sum()
+    return dict(zip(rows.index.tolist(), rows.tolist())), latest, top_items
+
+
+def run_item_forecast_for_database(conn_str, top_n=200, mmap_dir=None,
+                                   location_ids=None, latest_date=None, top_items=None, fit_kwargs=None):
+    # fit_kwargs: Prophet.fit limits from prophet_fit_kwargs (timeout / iteration / tolerance caps)
+    engine = sqlalchemy.create_engine(conn_str)
+    # Shards pass their locations plus the tenant-wide latest day and top items (see
+    # plan_item_shards); all three are pushed into SQL so a shard only loads the
+    # rows plan_item_shards sized it by
+    filters, params, expanding = [], {}, []
+    if location_ids is not None:
+        filters.append('AND location_id IN :location_ids')
+        params['location_ids'] = list(location_ids)
+        expanding.append(sqlalchemy.bindparam('location_ids', expanding=True))
+    if top_items is not None:
+        filters.append('AND item_id IN :top_items')
+        params['top_items'] = list(top_items)
+        expanding.append(sqlalchemy.bindparam('top_items', expanding=True))
+    if latest_date is not None:
+        filters.append('AND sale_time >= :cutoff')
+        params['cutoff'] = (latest_date - pd.DateOffset(months=12)).to_pydatetime()
+    item_sql = text(ITEM_DAILY_SQL.format(filters=' '.join(filters))).bindparams(*expanding)
+    daily = pd.read_sql(item_sql, engine, params=params or None, parse_dates=['sale_date'])
     if daily.empty:
         print("[WARN] No sales found.")
         return pd.DataFrame()
-    cutoff = daily['sale_date'].max() - pd.DateOffset(months=12)
+    if latest_date is None:
+        latest_date = daily['sale_date'].max()
+    cutoff = latest_date - pd.DateOffset(months=12)
     last_year = daily[daily['sale_date'] >= cutoff]
-    top_items = (last_year.groupby('item_id')['qty']
-                 .sum()
-                 .nlargest(top_n)
-                 .index.tolist())
+    if top_items is None:
+        top_items = (last_year.groupby('item_id')['qty']
+                     .sum()
+                     .nlargest(top_n)
+                     .index.tolist())
     last_year = last_year[last_year['item_id'].isin(top_items)]
 
+    # Dense (location, item) x day matrix, built once; row i <-> stats row i
+    matrix = build_demand_matrix(
+        last_year, ['location_id', 'item_id'], date_col='sale_date', y_col='qty',
+        start=cutoff, end=latest_date, mmap_dir=mmap_dir
+    )
+    stats = history_stats(matrix)
+
     results = []
     min_days, min_weeks, lead_days = 20, 4, 7
-    for (loc, item), grp in last_year.groupby(['location_id', 'item_id']):
-        grp = grp.sort_values('sale_date')
-        hist = grp.rename(columns={'sale_date': 'ds', 'qty': 'y'})
-        enough_days = hist['ds'].nunique() >= min_days
-        enough_weeks = hist['ds'].dt.isocalendar().week.nunique() >= min_weeks
-        enough = enough_days and enough_weeks
+    stats['enough_history'] = (
+        (stats['num_days_with_sales'] >= min_days) &
+        (stats['num_weeks_with_sales'] >= min_weeks)
+    )
+    fit_seconds, timed_out, failed = [], [], []
+    for i, (loc, item) in enumerate(matrix.index[['location_id', 'item_id']].itertuples(index=False)):
+        enough = stats.at[i, 'enough_history']
 
         reorder, replenish, sigma_lt, z_sel = 0, 0, 1, 1.65
+        # ok / timeout / failed: Prophet fit; fallback: not enough history for one
+        fit_status = 'fallback'
         try:
             if enough:
+                ds, y = matrix.observed(i)
+                hist = pd.DataFrame({'ds': ds, 'y': y})
                 m = Prophet(daily_seasonality=True)
-                m.fit(hist)
+                started = time.perf_counter()
+                fit_prophet(m, hist, fit_kwargs)
+                fit_seconds.append(time.perf_counter() - started)
+                fit_status = 'ok'
                 fc = m.predict(m.make_future_dataframe(periods=lead_days)).tail(lead_days)
                 demand_lt = fc['yhat'].sum()
                 sigma_lt = (fc['yhat_upper'].sum() - fc['yhat_lower'].sum()) / 3.29
-                cv = hist['y'].std() / hist['y'].mean() if hist['y'].mean() else 1
+                cv = stats.at[i, 'cv'] if stats.at[i, 'mean'] else 1
                 z_sel = 1.65 if cv < 0.5 else (2.0 if cv < 1.0 else 2.33)
                 reorder = int(np.round(demand_lt + z_sel * sigma_lt))
                 replenish = int(np.round(reorder + demand_lt))
             else:
-                demand_lt = hist.tail(7)['y'].mean() * lead_days
+                demand_lt = matrix.last_observed_mean(i) * lead_days
                 reorder = int(np.round(demand_lt))
                 replenish = int(np.round(demand_lt * 2))
-        except Exception:
-            demand_lt = hist.tail(7)['y'].mean() * lead_days
+        except Exception as exc:
+            if isinstance(exc, TimeoutError):
+                fit_status = 'timeout'
+                timed_out.append((loc, item))
+            else:
+                fit_status = 'failed'
+                failed.append(((loc, item), repr(exc)))
+            demand_lt = matrix.last_observed_mean(i) * lead_days
             reorder = int(np.round(demand_lt))
             replenish = int(np.round(demand_lt * 2))
 
@@ -152,10 +248,31 @@ def run_item_forecast_for_database(conn_str, top_n=200):
             'enough_history': enough,
             'z_score': z_sel,
             'demand_lt': demand_lt,
-            'sigma_lt': sigma_lt
+            'sigma_lt': sigma_lt,
+            'fit_status': fit_status
         })
 
-    return pd.DataFrame(results)
+    report_fit_times('item', fit_seconds, timed_out, failed)
+    results_df = pd.DataFrame(results)
+    return results_df
+
+
+def run_item_forecast_sharded(conn_str, max_rows_per_shard, max_workers=1, memory_limit_mb=None,
+                              on_shard=None, top_n=200, mmap_dir=None, fit_kwargs=None):
+    # Same results as run_item_forecast_for_database, one location group at a time
+    engine = sqlalchemy.create_engine(conn_str)
+    location_rows, latest_date, top_items = plan_item_shards(engine, top_n)
+    if not location_rows:
+        print("[WARN] No sales found.")
+        return pd.DataFrame()
+    shards = plan_shards(location_rows, max_rows_per_shard)
+    print(f"[SHARD] {len(location_rows)} locations -> {len(shards)} shards")
+    fn = partial(
+        run_item_forecast_for_database, conn_str, top_n=top_n, mmap_dir=mmap_dir,
+        latest_date=latest_date, top_items=top_items, fit_kwargs=fit_kwargs
+    )
+    parts = run_shards(fn, shards, max_workers, memory_limit_mb, on_result=on_shard)
+    return pd.concat(parts, ignore_index=True)
 
 # ---------- 3. DB discovery ----------
 
@@ -198,8 +315,68 @@ def main():
         'db_arg',
         help="Use -1 for all DBs, a positive number (e.g. 5) for first N DBs, or a DB name for just that one"
     )
+    parser.add_argument(
+        '--mmap-dir',
+        default=None,
+        help="Directory for memory-mapping the demand matrix of very large tenants (default: keep in RAM)"
+    )
+    parser.add_argument(
+        '--output-dir',
+        default='forecast_output',
+        help="Root of the Parquet output dataset (partitioned by run date and tenant)"
+    )
+    parser.add_argument(
+        '--shard-rows',
+        type=int,
+        default=0,
+        help="Process each tenant in location shards of at most ~N daily rows (0 = whole tenant at once)"
+    )
+    parser.add_argument(
+        '--shard-workers',
+        type=int,
+        default=1,
+        help="Number of shards forecast in parallel when --shard-rows is set"
+    )
+    parser.add_argument(
+        '--memory-limit-mb',
+        type=int,
+        default=None,
+        help="Memory ceiling for shards in flight (estimated from their row counts)"
+    )
+    parser.add_argument(
+        '--write-mode',
+        choices=['changed', 'all'],
+        default='changed',
+        help="changed = only upsert forecasted levels that moved, all = rewrite every row"
+    )
+    parser.add_argument(
+        '--level-tolerance',
+        type=int,
+        default=0,
+        help="With --write-mode changed, ignore level changes of at most this many units"
+    )
+    parser.add_argument(
+        '--fit-timeout',
+        type=float,
+        default=DEFAULT_FIT_TIMEOUT,
+        help="Seconds a single Prophet fit, including its Newton retry, may run before it is killed and the series falls back (0 = no limit)"
+    )
+    parser.add_argument(
+        '--fit-max-iter',
+        type=int,
+        default=None,
+        help="Cap on optimizer iterations per Prophet fit (default: Prophet's 10000)"
+    )
+    parser.add_argument(
+        '--fit-tol-rel-grad',
+        type=float,
+        default=None,
+        help="Relative gradient tolerance for L-BFGS fits (series with >= 100 days, not the Newton retry; default: CmdStan's)"
+    )
     args = parser.parse_args()
     arg = args.db_arg
+    run_date = pd.Timestamp.today().date()
+    fit_kwargs = prophet_fit_kwargs(args.fit_timeout, args.fit_max_iter, args.fit_tol_rel_grad)
 
     for server in DB_SERVERS:
         dbs_to_process = get_databases_to_process()
@@ -232,15 +409,34 @@ def main():
 
             try:
                 ensure_schema(engine)
-
-                item_df = run_item_forecast_for_database(conn_str, top_n=200)
-
-                if item_df.empty:
-                    print(f"[SKIPPED] No item sales for DB: {db}")
-                    continue
-
-                write_results_to_db(item_df, engine)
-                upsert_forecasted_levels_for_items(item_df, engine)
+                reset_partition(args.output_dir, 'item', run_date, db)
+
+                if args.shard_rows:
+                    # Each shard is written out as soon as it finishes
+                    def write_shard(shard_no, shard_df, db=db, engine=engine):
+                        write_partition(shard_df, args.output_dir, 'item', db, run_date, part=shard_no)
+                        write_results_to_db(shard_df, engine)
+                        write_forecasted_levels_for_items(shard_df, engine, args.write_mode, args.level_tolerance)
+
+                    item_df = run_item_forecast_sharded(
+                        conn_str, args.shard_rows, args.shard_workers, args.memory_limit_mb,
+                        on_shard=write_shard, top_n=200, mmap_dir=args.mmap_dir, fit_kwargs=fit_kwargs
+                    )
+                    if item_df.empty:
+                        print(f"[SKIPPED] No item sales for DB: {db}")
+                        continue
+                else:
+                    item_df = run_item_forecast_for_database(
+                        conn_str, top_n=200, mmap_dir=args.mmap_dir, fit_kwargs=fit_kwargs
+                    )
+
+                    if item_df.empty:
+                        print(f"[SKIPPED] No item sales for DB: {db}")
+                        continue
+
+                    write_partition(item_df, args.output_dir, 'item', db, run_date)
+                    write_results_to_db(item_df, engine)
+                    write_forecasted_levels_for_items(item_df, engine, args.write_mode, args.level_tolerance)
 
                 print(f"[DONE] Forecasting complete for {db}")
 
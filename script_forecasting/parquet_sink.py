@@ -0,0 +1,97 @@
+"""
+    Columnar output sink: Parquet dataset partitioned by run date and tenant.
+
+    <root>/<kind>/run_date=YYYY-MM-DD/tenant=<db>/part-00000.parquet
+    <root>/<kind>/run_date=YYYY-MM-DD/tenant=<db>/_manifest.json
+
+    One file is written per tenant (or per shard) as soon as it finishes, so a crash
+    only loses the tenant in flight. reset_partition() clears a tenant's earlier
+    output for the same run date before it is written again. Each tenant keeps its own
+    manifest, so concurrent invocations working on different tenants never rewrite
+    the same file. Readers scan only the partitions they need, e.g.
+    pyarrow.dataset.dataset(root + '/variation', partitioning='hive').
+"""
+
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DEFAULT_COMPRESSION = 'zstd'
+MANIFEST_NAME = '_manifest.json'
+
+
+def partition_dir(root, kind, run_date, tenant):
+    return os.path.join(root, kind, f"run_date={run_date}", f"tenant={tenant}")
+
+
+def _atomic_write(path, write):
+    # Unique temp name in the target directory (same filesystem for os.replace); the
+    # leading '.' keeps half-written files out of dataset discovery
+    fd, tmp = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix='.tmp',
+                               dir=os.path.dirname(path))
+    os.close(fd)
+    os.chmod(tmp, 0o644)  # mkstemp creates 0600
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def update_manifest(root, kind, run_date, entry):
+    # One manifest per tenant; re-writing a part replaces its entry
+    tenant = entry['tenant']
+    path = os.path.join(partition_dir(root, kind, run_date, tenant), MANIFEST_NAME)
+    manifest = {'kind': kind, 'run_date': str(run_date), 'tenant': tenant, 'files': []}
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+    manifest['files'] = [e for e in manifest['files'] if e['part'] != entry['part']] + [entry]
+    manifest['updated_at'] = datetime.now().isoformat(timespec='seconds')
+
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2, default=str)
+    _atomic_write(path, write)
+
+
+def reset_partition(root, kind, run_date, tenant):
+    # Call once when a tenant starts, before any of its parts are written: a re-run
+    # (retry, different shard count) must not leave parts of an earlier run behind.
+    # The tenant's manifest lives in the same directory and goes with it.
+    run_date = run_date or pd.Timestamp.today().date()
+    shutil.rmtree(partition_dir(root, kind, run_date, tenant), ignore_errors=True)
+
+
+def write_partition(df, root, kind, tenant, run_date=None, part=0, compression=DEFAULT_COMPRESSION):
+    # kind: 'variation', 'item' or 'sales_summary'
+    run_date = run_date or pd.Timestamp.today().date()
+    out_dir = partition_dir(root, kind, run_date, tenant)
+    os.makedirs(out_dir, exist_ok=True)
+    file_name = f"part-{part:05d}.parquet"
+    path = os.path.join(out_dir, file_name)
+
+    # run_date / tenant live in the directory names (hive partitioning), not in the file
+    table = pa.Table.from_pandas(
+        df.drop(columns=['run_date', 'tenant'], errors='ignore'), preserve_index=False
+    )
+    _atomic_write(path, lambda tmp: pq.write_table(table, tmp, compression=compression))
+
+    update_manifest(root, kind, run_date, {
+        'tenant': tenant,
+        'part': part,
+        'path': os.path.relpath(path, os.path.join(root, kind)),
+        'rows': table.num_rows,
+        'columns': table.column_names,
+        'compression': compression,
+        'written_at': datetime.now().isoformat(timespec='seconds'),
+    })
+    return path
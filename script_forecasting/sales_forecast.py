@@ -6,6 +6,9 @@ import pymysql   # for SHOW DATABASES
 #from prophet.serialize import model_to_json, model_from_json  # Only needed if you want to save/load Prophet models
 from datetime import datetime
 
+from fit_limits import DEFAULT_FIT_TIMEOUT, fit_prophet, prophet_fit_kwargs
+from parquet_sink import reset_partition, write_partition
+
 # ---- 1. RDS Config ----
 EXCLUDE_DBS = [
     'phpmyadmin', 'phpmyadmin2', 'horde', 'phppoint_forums', 'staging_site', 'sys',
@@ -77,7 +80,20 @@ def get_databases_to_process():
     return databases
 
 # ---- 3. Prophet Forecast Function (as before) ----
-def forecast_original(df_raw, periods=30, outlier_cap=30000, recent_months=3, dup_factor=3):
+def recent_average_forecast(df_recent, latest, periods, interval_z=1.44):
+    # Cheap fallback when the Prophet fit hits its time limit: flat recent mean,
+    # +/- interval_z * std (~85% interval, same width as the Prophet model below)
+    mean, std = df_recent['y'].mean(), df_recent['y'].std()
+    std = 0 if pd.isna(std) else std
+    ds = pd.date_range(latest + pd.Timedelta(days=1), periods=periods, freq='D')
+    return pd.DataFrame({
+        'ds': ds,
+        'yhat': mean,
+        'yhat_lower': mean - interval_z * std,
+        'yhat_upper': mean + interval_z * std
+    })
+
+def forecast_original(df_raw, periods=30, outlier_cap=30000, recent_months=3, dup_factor=3, fit_kwargs=None):
     df = df_raw.copy()
     df['sale_time'] = pd.to_datetime(df['sale_time'])
 
@@ -101,13 +117,18 @@ def forecast_original(df_raw, periods=30, outlier_cap=30000, recent_months=3, du
                 changepoint_prior_scale=0.8,
                 changepoint_range=0.98,
                 seasonality_mode='multiplicative')
-    m.fit(df_weighted)
-
-    future = m.make_future_dataframe(periods=periods, freq='D')
-    forecast = m.predict(future)
-    fc_future = forecast[forecast['ds'] > df_weighted['ds'].max()][
-        ['ds', 'yhat', 'yhat_lower', 'yhat_upper']
-    ]
+    timed_out = False
+    try:
+        fit_prophet(m, df_weighted, fit_kwargs)
+    except TimeoutError:
+        timed_out = True
+        fc_future = recent_average_forecast(df_recent, latest, periods)
+    else:
+        future = m.make_future_dataframe(periods=periods, freq='D')
+        forecast = m.predict(future)
+        fc_future = forecast[forecast['ds'] > df_weighted['ds'].max()][
+            ['ds', 'yhat', 'yhat_lower', 'yhat_upper']
+        ]
 
     summary = dict(
         avg_daily = fc_future['yhat'].mean(),
@@ -115,12 +136,14 @@ def forecast_original(df_raw, periods=30, outlier_cap=30000, recent_months=3, du
         total_est = fc_future['yhat'].sum(),
         total_low = fc_future['yhat_lower'].sum(),
         total_up  = fc_future['yhat_upper'].sum(),
-        days      = len(fc_future)
+        days      = len(fc_future),
+        fit_timed_out = timed_out
     )
     return fc_future, summary
 
 # ---- 4. Main Forecast Loop ----
-def process_forecasts():
+def process_forecasts(output_dir='forecast_output', fit_timeout=DEFAULT_FIT_TIMEOUT):
+    fit_kwargs = prophet_fit_kwargs(fit_timeout)
     dbs_to_process = get_databases_to_process()
     for db_name in dbs_to_process:
         print(f"\n--- Processing forecasts for DB: {db_name} ---")
@@ -147,13 +170,17 @@ def process_forecasts():
         summaries_original = {}
         for loc in location_ids:
             df_loc = df[df['location_id'] == loc]
-            fc, sm = forecast_original(df_loc, periods=30)
+            fc, sm = forecast_original(df_loc, periods=30, fit_kwargs=fit_kwargs)
             forecasts_original[loc] = fc
             summaries_original[loc] = sm
         # Total/all-location forecast
-        fc_total, sm_total = forecast_original(df, periods=30)
+        fc_total, sm_total = forecast_original(df, periods=30, fit_kwargs=fit_kwargs)
         summaries_original['ALL'] = sm_total
 
+        timed_out = [loc for loc, sm in summaries_original.items() if sm['fit_timed_out']]
+        if timed_out:
+            print(f"[TIMEOUT] {db_name}: fit limit hit for locations {timed_out}, used recent averages")
+
         # Ensure forecast table exists!
         ensure_forecast_table(engine)
         today = pd.Timestamp.today().date()
@@ -163,6 +190,15 @@ def process_forecasts():
             loc_id = 'ALL' if loc == 'ALL' else str(loc)
             write_forecast_to_db(engine, loc_id, sm, today)
 
+        # Same summaries to the Parquet dataset (partitioned by run date / tenant)
+        summary_df = pd.DataFrame([
+            {'location_id': 'ALL' if loc == 'ALL' else str(loc), 'forecast_date': today,
+             **sm, 'recommended_inventory': sm['total_est'] * 0.95}
+            for loc, sm in summaries_original.items()
+        ])
+        reset_partition(output_dir, 'sales_summary', today, db_name)
+        write_partition(summary_df, output_dir, 'sales_summary', db_name, today)
+
         # (Optional) Print summaries for reference
         for loc, sm in summaries_original.items():
             print(f"""
@@ -0,0 +1,69 @@
+"""
+    Location-sharded processing for very large tenants.
+
+    Locations are packed into shards by their (estimated) row count, every shard is
+    extracted, forecast and handed back as an independent unit, and shards run in
+    parallel worker processes only while their summed memory estimate fits the ceiling.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# Rough peak bytes per aggregated sales row while a shard is in flight (raw join,
+# agg frame, demand matrix, results). Only used to keep workers under the ceiling.
+# Shards are sized from exactly the rows their query loads: the daily aggregate of
+# the last 12 months (top items only for item shards).
+BYTES_PER_ROW = 2048
+
+
+def plan_shards(location_rows, max_rows_per_shard):
+    # location_rows: {location_id: row count}. Greedy packing in location order, so the
+    # concatenated shard results come out in the same order as an unsharded run.
+    # A location larger than the limit still gets a shard of its own.
+    shards, current, current_rows = [], [], 0
+    for loc in sorted(location_rows):
+        rows = location_rows[loc]
+        if current and current_rows + rows > max_rows_per_shard:
+            shards.append((current, current_rows))
+            current, current_rows = [], 0
+        current.append(loc)
+        current_rows += rows
+    if current:
+        shards.append((current, current_rows))
+    return shards
+
+
+def run_shards(fn, shards, max_workers=1, memory_limit_mb=None, bytes_per_row=BYTES_PER_ROW, on_result=None):
+    # fn(location_ids=[...]) -> DataFrame, must be a picklable module-level callable (or partial of one)
+    # on_result(shard_no, df) runs in the parent as each shard finishes (e.g. to write it out)
+    # Returns the shard results in shard order.
+    budget = memory_limit_mb * 1024 ** 2 if memory_limit_mb else None
+    results = [None] * len(shards)
+
+    if max_workers <= 1:
+        for shard_no, (locs, _) in enumerate(shards):
+            results[shard_no] = fn(location_ids=locs)
+            if on_result:
+                on_result(shard_no, results[shard_no])
+        return results
+
+    pending = list(enumerate(shards))
+    in_flight = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        while pending or in_flight:
+            # Start shards while workers are free and the estimate fits; always allow one
+            while pending and len(in_flight) < max_workers:
+                shard_no, (locs, rows) = pending[0]
+                need = rows * bytes_per_row
+                used = sum(n for _, n in in_flight.values())
+                if in_flight and budget is not None and used + need > budget:
+                    break
+                pending.pop(0)
+                in_flight[pool.submit(fn, location_ids=locs)] = (shard_no, need)
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                shard_no, _ = in_flight.pop(future)
+                results[shard_no] = future.result()
+                if on_result:
+                    on_result(shard_no, results[shard_no])
+    return results